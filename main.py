@@ -1,131 +1,245 @@
 import os
+import fcntl
+import re
+import tempfile
 import json
+import logging
 import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from flask import Flask, request, abort
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 from telegram import Bot, Update
 from telegram.ext import Dispatcher, CommandHandler
+from telegram.utils.request import Request
 import schedule
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(message)s')
+log = logging.getLogger('tls_bot')
+
 BOT_TOKEN = os.getenv('TELEGRAM_TOKEN')
 CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
 
 if not BOT_TOKEN or not CHANNEL_ID:
     raise RuntimeError("TELEGRAM_TOKEN and CHANNEL_ID must be set in environment variables")
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, request=Request(con_pool_size=8, connect_timeout=5, read_timeout=10))
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                                      max_retries=Retry(total=2, backoff_factor=0.3)))
+SESSION.headers.update({
+    'Accept-Encoding': 'gzip, deflate',
+    'User-Agent': 'Mozilla/5.0 (compatible; tls_it_bot)',
+    'Connection': 'keep-alive',
+})
+
 JSON_FILE = 'seen_posts.json'
+LOG_FILE = JSON_FILE + '.log'
 URL = 'https://it.tlscontact.com/by/MSQ/page.php?pid=news'
+NEWS_STRAINER = SoupStrainer(['h3', 'div', 'p'])
+
+_DATE_RE = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
 
 last_check_time = None
+_etag = None
+_last_modified = None
+_fetch_lock = threading.Lock()
+SCHEDULER_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'tls_it_bot_scheduler.lock')
+_scheduler_lock = None
 
+@lru_cache(maxsize=1024)
 def parse_date(date_str):
     clean_date = date_str.replace(' ', '').lower()
-    if clean_date in ['datenotfound', '', 'datenotfound']:
+    if clean_date in ['datenotfound', '']:
         return None
-    formats = ['%d/%m/%Y', '%m/%d/%Y']
-    for fmt in formats:
-        try:
-            return datetime.strptime(clean_date, fmt)
-        except ValueError:
-            continue
-    print(f"[ERROR init send] time data '{date_str}' does not match known formats")
+    m = _DATE_RE.match(clean_date)
+    if m:
+        a, b, year = int(m[1]), int(m[2]), int(m[3])
+        # day/month first, month/day as a fallback
+        for day, month in ((a, b), (b, a)):
+            try:
+                return datetime(year, month, day)
+            except ValueError:
+                continue
+    log.error("time data '%s' does not match known formats", date_str)
     return None
 
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def read_seen_log():
+    if os.path.exists(LOG_FILE):
+        with open(LOG_FILE, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json_loads(line)
+                except ValueError:
+                    # a torn last line from a crash mid-append is dropped
+                    if f.read(1):
+                        raise
+                    log.warning("Skipping unreadable last line in %s", LOG_FILE)
+
 def load_seen_posts():
+    posts = []
     if os.path.exists(JSON_FILE):
-        with open(JSON_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(JSON_FILE, 'rb') as f:
+            data = json_loads(f.read())
             if data and isinstance(data[0], str):
-                return [{'id': x, 'title': '', 'date': '', 'description': ''} for x in data]
-            return data
-    return []
+                posts = [{'id': x, 'title': '', 'date': '', 'description': ''} for x in data]
+            else:
+                posts = data
+    posts.extend(read_seen_log())
+    return OrderedDict((p['id'], p) for p in posts)
+
+def stored_fields(post):
+    return {k: v for k, v in post.items() if not k.startswith('_')}
+
+def append_seen_post(post):
+    with open(LOG_FILE, 'ab') as f:
+        f.write(json_dumps(stored_fields(post)) + b'\n')
 
 def save_seen_posts(posts):
-    posts_with_dates = [p for p in posts if parse_date(p['date']) is not None]
-    posts_without_dates = [p for p in posts if parse_date(p['date']) is None]
-    posts_with_dates.sort(key=lambda p: parse_date(p['date']), reverse=True)
-    sorted_posts = posts_with_dates + posts_without_dates
-    with open(JSON_FILE, 'w', encoding='utf-8') as f:
-        json.dump(sorted_posts, f, ensure_ascii=False, indent=2)
+    decorated = [(parse_date(p['date']), p) for p in posts]
+    with_dates = sorted([(d, p) for d, p in decorated if d], key=lambda t: t[0], reverse=True)
+    without_dates = [p for d, p in decorated if d is None]
+    sorted_posts = [stored_fields(p) for p in [p for _, p in with_dates] + without_dates]
+    tmp_file = JSON_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(json_dumps(sorted_posts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, JSON_FILE)
+    if os.path.exists(LOG_FILE):
+        os.remove(LOG_FILE)
 
 seen_posts = load_seen_posts()
-seen_ids = set(p['id'] for p in seen_posts)
 
 def fetch_news(send_last_only=False):
-    global seen_posts, seen_ids, last_check_time
+    if not _fetch_lock.acquire(blocking=False):
+        log.warning("Fetch already running, skipping.")
+        return
     try:
-        print("Checking news...")
-        response = requests.get(URL, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        headings = soup.find_all('h3', class_='mb-0')
-        if not headings:
-            print("No news found on the page.")
-            return
-
-        all_news = []
-        for h3 in headings:
-            title = h3.get_text(strip=True)
+        _fetch_news(send_last_only)
+    finally:
+        _fetch_lock.release()
+
+def _fetch_news(send_last_only):
+    global last_check_time, _etag, _last_modified
+    try:
+        log.debug("Checking news...")
+        headers = {}
+        if _etag and not send_last_only:
+            headers['If-None-Match'] = _etag
+        if _last_modified and not send_last_only:
+            headers['If-Modified-Since'] = _last_modified
+        with SESSION.get(URL, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304:
+                last_check_time = datetime.now()
+                log.debug("News page not modified.")
+                return
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            response.raw.decode_content = True
+            soup = BeautifulSoup(response.raw, 'lxml', parse_only=NEWS_STRAINER)
+        process_news(soup, send_last_only)
+        if not send_last_only:
+            _etag, _last_modified = etag, last_modified
+
+    except Exception as e:
+        log.error("Cannot get news: %s", e)
+
+def process_news(soup, send_last_only):
+    global seen_posts, last_check_time
+    headings = soup.find_all('h3', class_='mb-0')
+    if not headings:
+        log.warning("No news found on the page.")
+        return
+
+    all_news = []
+    for h3 in headings:
+        title = h3.get_text(strip=True)
+        parent_div = h3.parent
+        if parent_div is None or 'd-flex' not in parent_div.get('class', []):
             parent_div = h3.find_parent('div', class_='d-flex')
-            if not parent_div:
-                continue
-            date_p = parent_div.find_next_sibling('p')
-            date = date_p.find('strong').get_text(strip=True) if date_p and date_p.find('strong') else ''
-            desc_p = date_p.find_next_sibling('p') if date_p else None
-            description = desc_p.get_text(strip=True) if desc_p else ''
-            unique_id = f"{title}||{date}"
-            all_news.append({'id': unique_id, 'title': title, 'date': date, 'description': description})
-
-        valid_news = [n for n in all_news if parse_date(n['date']) is not None]
-        invalid_news = [n for n in all_news if parse_date(n['date']) is None]
-        valid_news.sort(key=lambda n: parse_date(n['date']), reverse=True)
-        all_news = valid_news + invalid_news
-
-        last_check_time = datetime.now()
-
-        if send_last_only:
-            if not seen_posts:
-                seen_posts = all_news.copy()
-                seen_ids = set(p['id'] for p in seen_posts)
-                save_seen_posts(seen_posts)
-                print("Initialized seen_posts with existing news.")
-            if all_news:
-                last = all_news[0]
-                msg = f"*{last['title']}*\n_{last['date']}_\n\n{last['description']}"
-                bot.send_message(chat_id=CHANNEL_ID, text=msg, parse_mode='Markdown')
-                print("Last news sent at startup.")
-            return
-
-        new_found = False
-        for news in all_news:
-            if news['id'] not in seen_ids:
-                seen_ids.add(news['id'])
-                seen_posts.append(news)
-                msg = f"*{news['title']}*\n_{news['date']}_\n\n{news['description']}"
-                bot.send_message(chat_id=CHANNEL_ID, text=msg, parse_mode='Markdown')
-                print(f"Sent new news: {news['title']}")
-                new_found = True
-
-        if new_found:
-            save_seen_posts(seen_posts)
-        else:
-            print("No new news found.")
+        if not parent_div:
+            continue
+        date_p = parent_div.find_next_sibling('p')
+        date_strong = date_p.find('strong') if date_p else None
+        date = date_strong.get_text(strip=True) if date_strong else ''
+        desc_p = date_p.find_next_sibling('p') if date_p else None
+        description = desc_p.get_text(strip=True) if desc_p else ''
+        unique_id = f"{title}||{date}"
+        all_news.append({
+            'id': unique_id, 'title': title, 'date': date, 'description': description,
+            '_msg': f"*{title}*\n_{date}_\n\n{description}",
+        })
+
+    decorated = [(parse_date(n['date']), n) for n in all_news]
+    valid_news = sorted([(d, n) for d, n in decorated if d], key=lambda t: t[0], reverse=True)
+    invalid_news = [n for d, n in decorated if d is None]
+    all_news = [n for _, n in valid_news] + invalid_news
+
+    last_check_time = datetime.now()
+
+    if send_last_only:
+        if not seen_posts:
+            seen_posts = OrderedDict((n['id'], n) for n in all_news)
+            save_seen_posts(seen_posts.values())
+            log.info("Initialized seen_posts with existing news.")
+        if all_news:
+            last = all_news[0]
+            bot.send_message(chat_id=CHANNEL_ID, text=last['_msg'], parse_mode='Markdown')
+            log.info("Last news sent at startup.")
+        return
+
+    new_items = OrderedDict((n['id'], n) for n in all_news if n['id'] not in seen_posts)
+    if not new_items:
+        log.debug("No new news found.")
+        return
 
+    for news in new_items.values():
+        bot.send_message(chat_id=CHANNEL_ID, text=news['_msg'], parse_mode='Markdown')
+        seen_posts[news['id']] = news
+        append_seen_post(news)
+        log.info("Sent new news: %s", news['title'])
+
+def compact_seen_posts():
+    try:
+        with _fetch_lock:
+            save_seen_posts(seen_posts.values())
+        log.debug("Compacted seen posts.")
     except Exception as e:
-        print(f"[Error] Cannot get news: {e}")
+        log.error("Cannot compact seen posts: %s", e)
 
 def check_command(update, context):
     update.message.reply_text("Bot is running")
 
 def lastnew_command(update, context):
     if seen_posts:
-        last = seen_posts[-1]
+        last = next(reversed(seen_posts.values()))
         date_str = last_check_time.strftime("%Y-%m-%d %H:%M:%S") if last_check_time else "unknown"
         msg = (
             f"*Last news:*\n"
@@ -154,15 +268,36 @@ def webhook():
 
 def run_schedule():
     schedule.every(5).minutes.do(fetch_news)
+    schedule.every().day.do(compact_seen_posts)
+    compact_seen_posts()
     fetch_news(send_last_only=True)
     while True:
+        delay = schedule.idle_seconds()
+        if delay is None:
+            break
+        if delay > 0:
+            time.sleep(delay)
         schedule.run_pending()
-        time.sleep(1)
 
-if __name__ == '__main__':
+def start_scheduler():
+    global _scheduler_lock
+    lock = open(SCHEDULER_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        log.info("Scheduler is owned by another process.")
+        return
+    _scheduler_lock = lock
     thread = threading.Thread(target=run_schedule, daemon=True)
     thread.start()
+
+if __name__ != '__main__' and os.getenv('RUN_SCHEDULER') == '1':
+    start_scheduler()
+
+if __name__ == '__main__':
+    start_scheduler()
     port = int(os.getenv('PORT', 5000))
-    print(f"[INFO] Flask запускается на порту {port}")
+    log.info("Flask запускается на порту %s", port)
     app.run(host='0.0.0.0', port=port)
 